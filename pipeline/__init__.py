@@ -0,0 +1,26 @@
+'''
+DataJoint pipeline for Economo et al., 2018
+Importing the schema modules does not connect to the database - call activate() before using the tables
+'''
+import importlib
+
+# schema modules, in dependency order
+schema_modules = ('reference', 'subject', 'acquisition', 'analysis', 'behavior', 'extracellular')
+
+
+def activate(schema_prefix=None, *, connection=None, create_schema=True, create_tables=True):
+    """
+    Activate all schemas of this pipeline, connecting to the database - schemas already activated are left as is
+    :param schema_prefix: prefix of the database schema names (default: dj.config['custom']['database.prefix'])
+    :param connection: datajoint.Connection to use (default: dj.conn())
+    """
+    import datajoint as dj
+
+    if schema_prefix is None:
+        schema_prefix = dj.config['custom'].get('database.prefix', '')
+
+    for module_name in schema_modules:
+        schema = importlib.import_module('.' + module_name, __name__).schema
+        if schema.database is None:
+            schema.activate(schema_prefix + module_name, connection=connection,
+                            create_schema=create_schema, create_tables=create_tables)
@@ -1,16 +1,8 @@
-import re
-import os
-import sys
-from datetime import datetime
-
-import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
-from . import reference, subject, utilities
+from . import reference, subject
 
-schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'acquisition')
+schema = dj.schema()  # activated by pipeline.activate()
 
 
 @schema
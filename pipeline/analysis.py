@@ -2,18 +2,12 @@
 '''
 Schema of analysis data.
 '''
-import re
-import os
-from datetime import datetime
-
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
-from . import reference, utilities, acquisition
+from . import reference, acquisition
 
-schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'analysis')
+schema = dj.schema()  # activated by pipeline.activate()
 
 
 @schema
@@ -1,20 +1,12 @@
 '''
 Schema of behavioral information.
 '''
-import re
-import os
-from datetime import datetime
-import sys
-
-import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
-from . import utilities, acquisition, analysis
+from . import acquisition
 
 
-schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'behavior')
+schema = dj.schema()  # activated by pipeline.activate()
 
 
 @schema
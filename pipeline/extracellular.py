@@ -1,16 +1,11 @@
-import re
-import os
 import sys
-from datetime import datetime
 
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import tqdm
 
-from . import (reference, utilities, acquisition, analysis)
+from . import (reference, utilities, acquisition, analysis, npy_store)
 
-schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'extracellular')
+schema = dj.schema()  # activated by pipeline.activate()
 
 
 @schema
@@ -36,6 +31,31 @@ class UnitSpikeTimes(dj.Manual):
     spike_times: longblob  # (s) time of each spike, with respect to the start of session 
     """
 
+    def iter_batches(self, *attrs, batch_size=100, prefetch=False, **fetch_kwargs):
+        """
+        Iterate over the units of this (restricted) table in batches of "batch_size" units - one query per batch,
+        optionally with the next batch prefetched in the background (see utilities.fetch_in_batches)
+        e.g. for units in (UnitSpikeTimes & 'unit_cell_type="PTupper"').iter_batches(as_dict=True): ...
+        """
+        return utilities.fetch_in_batches(self, *attrs, batch_size=batch_size, prefetch=prefetch, **fetch_kwargs)
+
+
+@schema
+class UnitSpikeTimeIndex(dj.Computed):
+    definition = """ # coarse time index into the (ascending) spike times of a unit, for fast time-window extraction
+    -> UnitSpikeTimes
+    ---
+    bucket_start: float  # (s) start time of the first time bucket, with respect to the start of session
+    bucket_size: float  # (s) duration of each time bucket
+    bucket_offsets: longblob  # index of the first spike at or after the start of each bucket, followed by the spike count
+    """
+
+    _bucket_size = 10  # (s)
+
+    def make(self, key):
+        spike_times = (UnitSpikeTimes & key).fetch1('spike_times')
+        self.insert1(dict(key, **build_spike_time_index(spike_times, self._bucket_size)))
+
 
 @schema
 class TrialSegmentedUnitSpikeTimes(dj.Computed):
@@ -47,9 +67,13 @@ class TrialSegmentedUnitSpikeTimes(dj.Computed):
     segmented_spike_times: longblob
     """
 
-    key_source = ProbeInsertion * analysis.TrialSegmentationSetting
+    @property
+    def key_source(self):
+        return ProbeInsertion * analysis.TrialSegmentationSetting
 
     def make(self, key):
+        import tqdm
+
         unit_ids, spike_times = (UnitSpikeTimes & key).fetch('unit_id', 'spike_times')  # spike_times from all units
         trial_keys = (acquisition.TrialSet.Trial & key).fetch('KEY')
 
@@ -92,4 +116,70 @@ class PSTH(dj.Computed):
         return NotImplementedError
 
 
+def build_spike_time_index(spike_times, bucket_size):
+    spike_times = np.asarray(spike_times, dtype=float).ravel()
+    if np.any(np.diff(spike_times) < 0):
+        raise ValueError('spike times are not in ascending order - no time index can be built')
+    if not spike_times.size:
+        return dict(bucket_start=0, bucket_size=bucket_size, bucket_offsets=np.zeros(2, dtype=np.int64))
+    bucket_start = np.floor(spike_times[0] / bucket_size) * bucket_size
+    bucket_count = int((spike_times[-1] - bucket_start) // bucket_size) + 1
+    bucket_edges = bucket_start + bucket_size * np.arange(bucket_count + 1)
+    return dict(bucket_start=bucket_start, bucket_size=bucket_size,
+                bucket_offsets=np.searchsorted(spike_times, bucket_edges, side='left').astype(np.int64))
 
+
+def get_windowed_spike_times(units, event_times, pre_stim_duration, post_stim_duration):
+    """
+    Extract the spike times of a set of units within arbitrary time windows, without having to define (and populate)
+    a new TrialSegmentationSetting - window: [event_time - pre_stim_duration, event_time + post_stim_duration]
+    When the npy store is configured, spike times are memory-mapped and only the UnitSpikeTimeIndex buckets
+    overlapping each window are read; otherwise the cut is done on the full (sorted) spike times with np.searchsorted
+    Windows with a non-finite (e.g. nan) event time or duration give empty segments
+    :param units: restriction of UnitSpikeTimes (typically units from one session)
+    :param event_times: (s) N time points, with respect to the start of session
+    :param pre_stim_duration, post_stim_duration: (s) scalar, or one value per time point
+    :return: unit_keys, segmented_spike_times - per unit, a list of N arrays of spike times relative to each event time
+    """
+    event_times = np.atleast_1d(np.asarray(event_times, dtype=float))
+    win_starts = event_times - np.broadcast_to(np.asarray(pre_stim_duration, dtype=float), event_times.shape)
+    win_ends = event_times + np.broadcast_to(np.asarray(post_stim_duration, dtype=float), event_times.shape)
+    is_valid = np.isfinite(win_starts) & np.isfinite(win_ends)
+    empty_segment = np.empty(0)
+
+    units = UnitSpikeTimes & units
+    unit_keys, spike_times = npy_store.fetch(units, 'spike_times')  # plain database fetch if no npy store
+
+    time_indices = {tuple(idx[k] for k in units.primary_key): idx
+                    for idx in (UnitSpikeTimeIndex & units).fetch(as_dict=True)}
+
+    segmented_spike_times = []
+    for unit_key, spk in zip(unit_keys, spike_times):
+        time_index = time_indices.get(tuple(unit_key[k] for k in units.primary_key))
+        if isinstance(spk, np.memmap) and time_index is not None:
+            # read only the buckets overlapping each window from the memory-mapped spike times
+            # (the index is only built for ascending spike times)
+            offsets = time_index['bucket_offsets']
+            bucket_from, bucket_to = (np.clip(np.floor((np.where(is_valid, t, time_index['bucket_start'])
+                                                        - time_index['bucket_start']) / time_index['bucket_size']),
+                                              0, len(offsets) - 2).astype(int) for t in (win_starts, win_ends))
+            unit_segments = []
+            for t, t_start, t_end, valid, i_from, i_to in zip(event_times, win_starts, win_ends, is_valid,
+                                                              offsets[bucket_from], offsets[bucket_to + 1]):
+                if not valid:
+                    unit_segments.append(empty_segment)
+                    continue
+                bucket_spk = np.asarray(spk[i_from:i_to])
+                unit_segments.append(bucket_spk[np.searchsorted(bucket_spk, t_start, side='left'):
+                                                np.searchsorted(bucket_spk, t_end, side='right')] - t)
+        else:
+            spk = np.asarray(spk, dtype=float).ravel()
+            if np.any(np.diff(spk) < 0):
+                spk = np.sort(spk)
+            i_starts = np.searchsorted(spk, win_starts, side='left')
+            i_ends = np.searchsorted(spk, win_ends, side='right')
+            unit_segments = [spk[i_start:i_end] - t if valid else empty_segment
+                             for t, valid, i_start, i_end in zip(event_times, is_valid, i_starts, i_ends)]
+        segmented_spike_times.append(unit_segments)
+
+    return unit_keys, segmented_spike_times
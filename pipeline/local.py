@@ -0,0 +1,63 @@
+'''
+Local mode - run the pipeline on a single machine (laptop, CI) against a MySQL server on the loopback interface,
+e.g. the "datajoint/mysql" docker image, with the large arrays in the npy store on the local file-system
+'''
+import os
+import importlib
+
+import datajoint as dj
+
+default_local_database = {'database.host': '127.0.0.1',
+                          'database.port': 3306,
+                          'database.user': 'root',
+                          'database.password': 'simple'}  # "datajoint/mysql" docker image defaults
+
+
+def configure(data_dir, schema_prefix='economo2018_', **database):
+    """
+    Point dj.config to the local database, and the npy store to <data_dir>/npy_store
+    :param database: overrides of default_local_database, e.g. port=3307 (keys without the "database." prefix)
+    """
+    dj.config.update(default_local_database)
+    dj.config.update({'database.' + k: v for k, v in database.items()})
+    dj.config['custom'] = {**(dj.config.get('custom') or {}),
+                           'database.prefix': schema_prefix,
+                           'npy_store.location': os.path.join(os.path.abspath(data_dir), 'npy_store')}
+
+
+def _get_activated_connection(schema_prefix, host, port):
+    """
+    Connection of the schemas already activated, None if none is
+    Raise DataJointError if any is activated on another database server or with another schema prefix
+    """
+    from . import schema_modules
+
+    connection = None
+    for module_name in schema_modules:
+        schema = importlib.import_module('.' + module_name, __package__).schema
+        if schema.database is None:
+            continue
+        conn_info = schema.connection.conn_info
+        if (schema.database != schema_prefix + module_name
+                or (conn_info['host'], int(conn_info['port'])) != (host, int(port))):
+            raise dj.DataJointError(
+                f'Schema "{schema.database}" is already activated on {conn_info["host"]}:{conn_info["port"]} - '
+                f'the local mode must be activated before any other use of the pipeline (restart the kernel)')
+        connection = schema.connection
+    return connection
+
+
+def activate(data_dir, schema_prefix='economo2018_', **database):
+    """
+    Configure the local mode (see configure()), then activate all schemas of the pipeline
+    Schemas are bound to their database once activated: this raises DataJointError, leaving dj.config unchanged,
+    if the pipeline was already activated on another database (e.g. by pipeline.activate() in an imported script)
+    """
+    from . import activate as activate_pipeline
+
+    database_config = {**default_local_database, **{'database.' + k: v for k, v in database.items()}}
+    connection = _get_activated_connection(schema_prefix, database_config['database.host'],
+                                           database_config['database.port'])
+
+    configure(data_dir, schema_prefix=schema_prefix, **database)
+    activate_pipeline(schema_prefix, connection=connection or dj.conn(reset=True))
@@ -0,0 +1,162 @@
+'''
+Local file-system store for the large array attributes (spike times, PSTH, lick times), kept as raw .npy files
+Large arrays are read back through memory-mapping, so only the pages actually accessed are read from disk
+The store location is set with dj.config['custom']['npy_store.location']
+Files are named after the primary key only: use remove() before deleting rows (or prune() after), so that
+re-inserted rows are not served from the files of the deleted ones
+'''
+import os
+
+import numpy as np
+import datajoint as dj
+from datajoint.hash import key_hash
+
+
+# attributes of each table that can be kept in the store
+stored_attributes = {'unit_spike_times': ('spike_times',),
+                     '__trial_segmented_unit_spike_times': ('segmented_spike_times',),
+                     '__p_s_t_h': ('psth',),
+                     'lick_times': ('lick_left_times', 'lick_right_times')}
+
+# files smaller than this are read into memory rather than memory-mapped - each memory-map holds an open file
+# descriptor, so mapping e.g. the many small per-trial arrays would run into the open files limit
+mmap_min_bytes = 1 << 20
+
+
+class NpyStoreError(Exception):
+    '''Raise when the npy store is not configured, or an attribute cannot be kept in the store'''
+    pass
+
+
+def is_configured():
+    return bool(dj.config['custom'].get('npy_store.location'))
+
+
+def get_store_location():
+    location = dj.config['custom'].get('npy_store.location')
+    if not location:
+        raise NpyStoreError('npy store is not configured - set dj.config["custom"]["npy_store.location"]')
+    return location
+
+
+def get_file_path(table, key, attribute):
+    """
+    Path of the .npy file for the "attribute" of the row "key" of "table":
+        <location>/<database>/<table_name>/<attribute>/<hash[:2]>/<hash>.npy
+    with <hash> the hash of the primary key values of this row
+    """
+    if attribute not in stored_attributes.get(table.table_name, ()):
+        raise NpyStoreError(f'{attribute} of {table.table_name} is not kept in the npy store')
+    khash = key_hash({k: key[k] for k in table.primary_key})
+    return os.path.join(get_store_location(), table.database, table.table_name, attribute, khash[:2], khash + '.npy')
+
+
+def save(table, key, attribute, value):
+    file_path = get_file_path(table, key, attribute)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(value), allow_pickle=False)
+    os.replace(tmp_path, file_path)  # so concurrent readers never see a partially written file
+
+
+def load(table, key, attribute, mmap_mode='r'):
+    """
+    Load the "attribute" of the row "key" of "table" from the npy store
+    Files of at least mmap_min_bytes are memory-mapped (unless mmap_mode=None), smaller ones are read into memory
+    Return None if this row is not in the store
+    """
+    file_path = get_file_path(table, key, attribute)
+    try:
+        file_size = os.path.getsize(file_path)
+    except FileNotFoundError:
+        return None
+    if mmap_mode is None or file_size < mmap_min_bytes:
+        return np.load(file_path)
+    return np.load(file_path, mmap_mode=mmap_mode)
+
+
+def fetch(query, attribute, mmap_mode='r'):
+    """
+    Fetch the "attribute" of every row of "query" (a restricted table), reading the arrays from the npy store
+    Only the primary keys are fetched from the database; the rows not yet in the store are fetched from the database
+    in one query (as is the whole query when the store is not configured)
+    :return: keys, values - the primary keys and the (memory-mapped) arrays, in the same order
+    """
+    def fetch_from_db(q):
+        entries = q.fetch(*query.primary_key, attribute, as_dict=True)
+        return [{k: e[k] for k in query.primary_key} for e in entries], [e[attribute] for e in entries]
+
+    if not is_configured():
+        return fetch_from_db(query)
+
+    keys = query.fetch('KEY')
+    values = [load(query, key, attribute, mmap_mode=mmap_mode) for key in keys]
+    missing_keys = [key for key, value in zip(keys, values) if value is None]
+    if missing_keys:
+        db_keys, db_values = fetch_from_db(query & missing_keys)
+        db_values = {tuple(k[a] for a in query.primary_key): v for k, v in zip(db_keys, db_values)}
+        values = [value if value is not None else db_values[tuple(key[a] for a in query.primary_key)]
+                  for key, value in zip(keys, values)]
+    return keys, values
+
+
+def migrate(query, attributes=None, batch_size=100, overwrite=False):
+    """
+    Copy the array attributes of the existing rows of "query" (a restricted table) into the npy store
+    Rows already in the store are skipped unless overwrite=True
+    :return: number of files written
+    """
+    import tqdm
+
+    attributes = attributes or stored_attributes.get(query.table_name, ())
+    if not attributes:
+        raise NpyStoreError(f'{query.table_name} has no attribute kept in the npy store')
+
+    keys = query.fetch('KEY')
+    if not overwrite:
+        keys = [k for k in keys
+                if not all(os.path.exists(get_file_path(query, k, attr)) for attr in attributes)]
+
+    file_count = 0
+    for slice_from in tqdm.tqdm(range(0, len(keys), batch_size)):
+        for entry in (query & keys[slice_from:slice_from + batch_size]).fetch(*query.primary_key, *attributes,
+                                                                               as_dict=True):
+            for attr in attributes:
+                save(query, entry, attr, entry[attr])
+                file_count += 1
+    return file_count
+
+
+def remove(query):
+    """
+    Remove the files of the rows of "query" (a restricted table) from the npy store - call before query.delete()
+    :return: number of files removed
+    """
+    file_count = 0
+    for key in query.fetch('KEY'):
+        for attr in stored_attributes.get(query.table_name, ()):
+            file_path = get_file_path(query, key, attr)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                file_count += 1
+    return file_count
+
+
+def prune(table):
+    """
+    Remove the files of the npy store with no matching row left in "table" (e.g. after rows were deleted)
+    :return: number of files removed
+    """
+    file_count = 0
+    keys = table.fetch('KEY')
+    for attr in stored_attributes.get(table.table_name, ()):
+        attr_dir = os.path.join(get_store_location(), table.database, table.table_name, attr)
+        kept_files = {get_file_path(table, key, attr) for key in keys}
+        for dir_path, _, file_names in os.walk(attr_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if file_path not in kept_files:
+                    os.remove(file_path)
+                    file_count += 1
+    return file_count
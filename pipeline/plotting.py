@@ -0,0 +1,133 @@
+'''
+Batch rendering of the per-unit ISI/PSTH panels of the demo notebook, for report generation
+The units to plot are given as a list of dicts (as returned by get_psth_isi() in the notebook), with:
+    isi: inter-spike intervals; l_psth, r_psth: mean PSTH of lick-left/right trials; mean_event_times: {event: time}
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .utilities import split_list
+
+isi_edges = np.arange(-.01, .01, .0005)  # (s)
+
+
+def smooth_psths(psths, sigma):
+    """ Gaussian-smooth all PSTHs in one pass - psths: array of (units x time bins) """
+    from scipy.ndimage import gaussian_filter1d
+
+    return gaussian_filter1d(np.asarray(psths, dtype=float), sigma, axis=-1)
+
+
+def isi_histograms(isis, edges=isi_edges):
+    """
+    Histograms of the symmetrized (ISI and -ISI) inter-spike intervals of all units in one pass - same binning as
+    np.histogram(..., bins=len(edges), range=(edges[0], edges[-1]))
+    :param isis: list of 1D arrays of inter-spike intervals, one per unit
+    :return: array of (units x len(edges)) - percentage of each unit's ISI count per bin
+    """
+    bin_count, (t_from, t_to) = len(edges), (edges[0], edges[-1])
+    isi_counts = np.array([len(isi) for isi in isis], dtype=int)
+    all_isi = np.concatenate([np.asarray(isi, dtype=float).ravel() for isi in isis] + [np.empty(0)])
+    unit_idx = np.tile(np.repeat(np.arange(len(isis)), isi_counts), 2)
+    all_isi = np.concatenate([all_isi, -all_isi])
+
+    in_range = (all_isi >= t_from) & (all_isi <= t_to)
+    bin_idx = np.minimum(((all_isi[in_range] - t_from) / (t_to - t_from) * bin_count).astype(int), bin_count - 1)
+    counts = np.bincount(unit_idx[in_range] * bin_count + bin_idx,
+                         minlength=len(isis) * bin_count).reshape(len(isis), bin_count)
+    return counts / np.maximum(isi_counts, 1)[:, None] * 100
+
+
+def _nan_limits(values, default=(0, 1)):
+    """ (min, max) of the values ignoring NaN/Inf (the mean PSTH are nanmean-ed) - "default" if none is finite """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    return (values.min(), values.max()) if values.size else default
+
+
+def _render_pages(pages, units_per_row, rows_per_page, psth_time, isi_bins, file_paths, row_height=0.75):
+    """
+    Render the pages into one reused figure (the artists are created once, then only their data are updated)
+    :param pages: list of pages, each a list of units as (isi_hist, l_psth, r_psth, event_times)
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(16, row_height * rows_per_page))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows_per_page, 2 * units_per_row, squeeze=False)
+    bin_width = isi_bins[1] - isi_bins[0]
+
+    panels = []
+    for isi_ax, psth_ax in zip(axes.ravel()[::2], axes.ravel()[1::2]):
+        bars = isi_ax.bar(isi_bins, np.zeros_like(isi_bins), width=bin_width)
+        l_line, = psth_ax.plot(psth_time, np.zeros_like(psth_time), 'r', linewidth=0.5)
+        r_line, = psth_ax.plot(psth_time, np.zeros_like(psth_time), 'b', linewidth=0.5)
+        isi_ax.set_xlim(isi_bins[0], isi_bins[-1] + bin_width)
+        psth_ax.set_xlim(psth_time[0], psth_time[-1])
+        panels.append((isi_ax, psth_ax, bars, l_line, r_line, []))
+
+    for page, file_path in zip(pages, file_paths):
+        for panel_idx, (isi_ax, psth_ax, bars, l_line, r_line, event_lines) in enumerate(panels):
+            visible = panel_idx < len(page)
+            isi_ax.set_visible(visible)
+            psth_ax.set_visible(visible)
+            if not visible:
+                continue
+            isi_hist, l_psth, r_psth, event_times = page[panel_idx]
+            for bar, height in zip(bars, isi_hist):
+                bar.set_height(height)
+            isi_ax.set_ylim(0, max(_nan_limits(isi_hist)[1], 1e-6) * 1.05)
+            l_line.set_ydata(l_psth)
+            r_line.set_ydata(r_psth)
+            psth_min, psth_max = _nan_limits(np.concatenate([l_psth, r_psth]))
+            psth_ax.set_ylim(psth_min, psth_max + 1e-6)
+            # event markers
+            while len(event_lines) < len(event_times):
+                event_lines.append(psth_ax.axvline(x=0, linestyle='--', linewidth=0.8, color='k'))
+            for line_idx, line in enumerate(event_lines):
+                line.set_visible(line_idx < len(event_times))
+                if line_idx < len(event_times):
+                    line.set_xdata([event_times[line_idx]] * 2)
+        fig.savefig(file_path)
+    return file_paths
+
+
+def plot_psth_isi_pages(units_psth, psth_time, output_dir, file_prefix='psth_isi', file_format='png',
+                        units_per_row=4, rows_per_page=10, sigma=2, workers=None):
+    """
+    Render the ISI histogram and smoothed PSTH of all units, as pages of "rows_per_page" x "units_per_row" units,
+    written to <output_dir>/<file_prefix>_<page>.<file_format> (png or pdf)
+    The PSTH smoothing and ISI histograms are computed for all units at once, and the pages are rendered in
+    parallel by "workers" processes (default: number of CPUs), each reusing a single figure
+    :return: list of the written file paths
+    """
+    if not units_psth:
+        return []
+    os.makedirs(output_dir, exist_ok=True)
+
+    unit_count = len(units_psth)
+    smoothed = smooth_psths(np.vstack([u['l_psth'] for u in units_psth] + [u['r_psth'] for u in units_psth]), sigma)
+    isi_hists = isi_histograms([u['isi'] for u in units_psth])
+    units = [(isi_hist, l_psth, r_psth, sorted(u['mean_event_times'].values()))
+             for u, isi_hist, l_psth, r_psth in zip(units_psth, isi_hists, smoothed[:unit_count], smoothed[unit_count:])]
+
+    isi_bins = np.linspace(isi_edges[0], isi_edges[-1], len(isi_edges) + 1)[:-1]  # left edge of each ISI bin
+
+    pages = list(split_list(units, units_per_row * rows_per_page))
+    file_paths = [os.path.join(output_dir, f'{file_prefix}_{page_idx:03d}.{file_format}')
+                  for page_idx in range(len(pages))]
+
+    workers = min(workers or os.cpu_count() or 1, len(pages))
+    if workers == 1:
+        return _render_pages(pages, units_per_row, rows_per_page, psth_time, isi_bins, file_paths)
+
+    pages_per_worker = -(-len(pages) // workers)  # ceil
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_render_pages, worker_pages, units_per_row, rows_per_page, psth_time,
+                                   isi_bins, worker_files)
+                   for worker_pages, worker_files in zip(split_list(pages, pages_per_worker),
+                                                         split_list(file_paths, pages_per_worker))]
+        return [f for future in futures for f in future.result()]
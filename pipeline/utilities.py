@@ -1,11 +1,6 @@
-import os
 from datetime import datetime
-import re
-
-import glob
-import numpy as np
-
-from . import reference, acquisition
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 
 time_unit_conversion_factor = {'millisecond': 1e-3,
@@ -33,4 +28,56 @@ def split_list(arr, size):
         slice_to = slice_from + size
         yield arr[slice_from:slice_to]
         slice_from = slice_to
-        
\ No newline at end of file
+        
+
+
+def serialize_queries(connection):
+    """
+    Make all queries on this DataJoint connection go through a lock, so that several threads can share it
+    (results are fully buffered by the cursor before query() returns, so the lock covers the whole exchange)
+    """
+    if getattr(connection, '_query_lock', None) is None:
+        query_lock = threading.RLock()
+        unlocked_query = connection.query
+
+        def query(*args, **kwargs):
+            with query_lock:
+                return unlocked_query(*args, **kwargs)
+
+        connection.query = query
+        connection._query_lock = query_lock
+    return connection
+
+
+def fetch_in_batches(query, *attrs, batch_size=100, batch_by=None, prefetch=False, **fetch_kwargs):
+    """
+    Generator fetching "query" in batches, with one database query per batch
+    Each batch holds the rows of "batch_size" distinct values of the "batch_by" attributes (default: the primary key
+    of "query"), e.g. batch_by=UnitSpikeTimes.primary_key to get all trials of a unit in the same batch
+    With prefetch=True, the next batch is fetched on a background thread while the current one is being processed,
+    so at most two batches are held in memory at once - the background thread shares the DataJoint connection, whose
+    queries are then serialized (see serialize_queries), so the caller can still issue its own queries while iterating
+    :param attrs, fetch_kwargs: passed on to query.fetch() for each batch
+    """
+    import datajoint as dj
+
+    batch_query = dj.U(*batch_by) & query if batch_by else query
+    keys = batch_query.fetch('KEY')
+
+    def fetch_batch(batch_keys):
+        return (query & batch_keys).fetch(*attrs, **fetch_kwargs)
+
+    batches = split_list(keys, batch_size)
+    if not prefetch:
+        for batch_keys in batches:
+            yield fetch_batch(batch_keys)
+        return
+
+    serialize_queries(query.connection)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_batch, next(batches)) if keys else None
+        while future is not None:
+            batch = future.result()
+            batch_keys = next(batches, None)
+            future = executor.submit(fetch_batch, batch_keys) if batch_keys else None
+            yield batch
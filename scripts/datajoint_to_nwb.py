@@ -8,7 +8,7 @@ import re
 import numpy as np
 import warnings
 
-from pipeline import (reference, subject, acquisition, analysis,
+from pipeline import (activate, reference, subject, acquisition, analysis,
                       extracellular, behavior, utilities)
 import pynwb
 from pynwb import NWBFile, NWBHDF5IO
@@ -61,13 +61,16 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
         probe = nwbfile.create_device(name = probe_insertion['probe_name'])
         electrode_group = nwbfile.create_electrode_group(
             name='; '.join([f'{probe_insertion["probe_name"]}: {str(probe_insertion["channel_counts"])}']),
-            description='N/A',
+            description=(f'insertion depth (um): {probe_insertion["insertion_depth"]}; '
+                         f'probe type: {(reference.Probe & probe_insertion).fetch1("probe_type")}'),
             device=probe,
             location='; '.join([f'{k}: {str(v)}' for k, v in
                                   (reference.BrainLocation & probe_insertion).fetch1().items()]))
 
+        nwbfile.add_electrode_column(name='shank_id', description='id of the probe shank this electrode is located on')
         for chn in (reference.Probe.Channel & probe_insertion).fetch(as_dict=True):
             nwbfile.add_electrode(id=chn['channel_id'],
+                                  shank_id=chn['shank_id'],
                                   group=electrode_group,
                                   filtering=hardware_filter,
                                   imp=np.nan,
@@ -180,5 +183,6 @@ if __name__ == '__main__':
     else:
         nwb_outdir = default_nwb_output_dir
 
+    activate()
     for skey in acquisition.Session.fetch('KEY'):
         export_to_nwb(skey, nwb_output_dir=nwb_outdir, save=True)
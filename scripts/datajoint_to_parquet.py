@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pipeline import (activate, acquisition, extracellular, behavior)
+
+# ============================== SET CONSTANTS ==========================================
+default_parquet_output_dir = os.path.join('data', 'parquet')
+# Each exported table is a Parquet dataset with hive-style partitions: <table>/subject_id=<...>/session=<...>/
+# the spike times exported one row per spike (explode_spikes) are a separate dataset: unit_spike_times_exploded
+exported_tables = ('unit', 'unit_spike_times', 'trial', 'trial_event', 'lick_times')
+partition_columns = ['subject_id', 'session']
+
+# explicit schema of each exported table, so that every partition (including empty ones) has the same column types
+unit_key_fields = [('probe_name', pa.string()), ('channel_counts', pa.int64()), ('brain_region', pa.string()),
+                   ('brain_subregion', pa.string()), ('cortical_layer', pa.string()), ('hemisphere', pa.string()),
+                   ('insertion_depth', pa.float64()), ('unit_id', pa.int64())]
+table_schemas = {
+    'unit': pa.schema(unit_key_fields + [('channel_id', pa.int64()), ('unit_cell_type', pa.string()),
+                                         ('unit_quality', pa.string()), ('unit_depth', pa.float64())]),
+    'unit_spike_times': pa.schema(unit_key_fields + [('spike_times', pa.list_(pa.float64()))]),
+    'unit_spike_times_exploded': pa.schema(unit_key_fields + [('spike_time', pa.float64())]),
+    'trial': pa.schema([('trial_id', pa.int64()), ('start_time', pa.float64()), ('trial_type', pa.string()),
+                        ('trial_response', pa.string()), ('trial_stim_present', pa.bool_()),
+                        ('trial_is_good', pa.bool_())]),
+    'trial_event': pa.schema([('trial_id', pa.int64()), ('trial_event', pa.string()), ('event_time', pa.float64()),
+                              ('session_event_time', pa.float64())]),
+    'lick_times': pa.schema([('lick_side', pa.string()), ('lick_time', pa.float64())])}
+
+
+def get_session_partition(session_key):
+    session = (acquisition.Session & session_key).fetch1()
+    return {'subject_id': session['subject_id'],
+            'session': '_'.join([session['session_time'].strftime('%Y-%m-%d'), str(session['session_id'])])}
+
+
+def get_partition_dir(output_dir, table_name, partition):
+    return os.path.join(output_dir, table_name, *[f'{k}={partition[k]}' for k in partition_columns])
+
+
+def get_exported_tables(explode_spikes=False):
+    return tuple(t + '_exploded' if explode_spikes and t == 'unit_spike_times' else t for t in exported_tables)
+
+
+def _session_tables(session_key, explode_spikes=False):
+    """
+    Build one pandas.DataFrame per exported table for this session
+    Trial event times and lick times are with respect to the start of the session
+    """
+    session_key = (acquisition.Session & session_key).fetch1('KEY')
+    tables = {}
+
+    # --- units ---
+    units = (extracellular.UnitSpikeTimes & session_key).fetch(as_dict=True)
+    spike_times = [np.asarray(u.pop('spike_times'), dtype=float).ravel() for u in units]
+    tables['unit'] = pd.DataFrame(units, columns=[c for c in extracellular.UnitSpikeTimes.heading.names
+                                                  if c not in list(session_key) + ['spike_times']])
+    tables['unit']['insertion_depth'] = tables['unit']['insertion_depth'].astype(float)  # decimal to float
+    unit_pk = [k for k in extracellular.UnitSpikeTimes.primary_key if k not in session_key]
+
+    if explode_spikes:
+        spike_counts = [len(spk) for spk in spike_times]
+        spikes = tables['unit'][unit_pk].loc[tables['unit'].index.repeat(spike_counts)].reset_index(drop=True)
+        spikes['spike_time'] = np.concatenate(spike_times) if spike_times else np.array([], dtype=float)
+        tables['unit_spike_times_exploded'] = spikes
+    else:
+        spikes = tables['unit'][unit_pk].copy()
+        spikes['spike_times'] = spike_times
+        tables['unit_spike_times'] = spikes
+
+    # --- trials ---
+    trials = pd.DataFrame((acquisition.TrialSet.Trial & session_key).fetch(as_dict=True))
+    tables['trial'] = trials.drop(columns=list(session_key), errors='ignore')
+
+    q_trial_event = (acquisition.TrialSet.EventTime * acquisition.TrialSet.Trial.proj('start_time')).proj(
+        'event_time', session_event_time='event_time + start_time')
+    events = pd.DataFrame((q_trial_event & session_key).fetch(as_dict=True))
+    tables['trial_event'] = events.drop(columns=list(session_key), errors='ignore')
+
+    # --- licks ---
+    if behavior.LickTimes & session_key:
+        left_licks, right_licks = (behavior.LickTimes & session_key).fetch1('lick_left_times', 'lick_right_times')
+        left_licks, right_licks = np.asarray(left_licks, dtype=float).ravel(), np.asarray(right_licks, dtype=float).ravel()
+        tables['lick_times'] = pd.DataFrame({'lick_side': ['left'] * len(left_licks) + ['right'] * len(right_licks),
+                                             'lick_time': np.concatenate([left_licks, right_licks])})
+    else:
+        tables['lick_times'] = pd.DataFrame()
+
+    return tables
+
+
+def _to_arrow(df, schema):
+    """ Convert "df" to a pyarrow.Table of exactly "schema" - empty frames give an empty table of that schema """
+    if df.empty:
+        return pa.Table.from_arrays([pa.array([], type=field.type) for field in schema], schema=schema)
+    df = df.reindex(columns=schema.names)
+    for field in schema:
+        if field.type == pa.bool_():
+            df[field.name] = df[field.name].astype(bool)
+        elif field.type == pa.float64() or field.type == pa.int64():
+            df[field.name] = df[field.name].astype(float if field.type == pa.float64() else int)
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def export_to_parquet(session_key, parquet_output_dir=default_parquet_output_dir,
+                      explode_spikes=False, overwrite=False):
+    """
+    Export one session into the partitioned Parquet datasets at "parquet_output_dir"
+    Sessions already exported are skipped (unless overwrite=True), so repeated calls only append new sessions
+    :param explode_spikes: write one row per spike (to the unit_spike_times_exploded dataset) instead of one
+        list-typed row per unit (to unit_spike_times) - both can be exported into the same "parquet_output_dir"
+    :return: True if the session was written, False if it was already exported
+    """
+    partition = get_session_partition(session_key)
+    if not overwrite and all(os.path.exists(get_partition_dir(parquet_output_dir, t, partition))
+                             for t in get_exported_tables(explode_spikes)):
+        return False
+
+    for table_name, df in _session_tables(session_key, explode_spikes=explode_spikes).items():
+        partition_dir = get_partition_dir(parquet_output_dir, table_name, partition)
+        # write into a temporary directory then swap in - readers never see a partially written partition
+        # (directories prefixed with "_" are ignored by Parquet dataset discovery)
+        tmp_dir = os.path.join(os.path.dirname(partition_dir), '_tmp_' + os.path.basename(partition_dir))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        pq.write_table(_to_arrow(df, table_schemas[table_name]), os.path.join(tmp_dir, 'part-0.parquet'))
+        shutil.rmtree(partition_dir, ignore_errors=True)
+        os.replace(tmp_dir, partition_dir)
+
+    print(f'Write Parquet partition: {partition["subject_id"]}/{partition["session"]}')
+    return True
+
+
+def read_parquet_table(table_name, parquet_output_dir=default_parquet_output_dir, filters=None, columns=None):
+    """
+    Read one exported table back as a pyarrow.Table, with the partition columns (subject_id, session) restored
+    Files are memory-mapped rather than read into intermediate buffers; use `filters` (e.g.
+    [('subject_id', '=', 'anm244028')]) to only open the matching partitions
+    """
+    dataset = pq.ParquetDataset(os.path.join(parquet_output_dir, table_name), filters=filters, memory_map=True)
+    return dataset.read(columns=columns)
+
+
+# ============================== EXPORT ALL ==========================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export all sessions to partitioned Parquet datasets')
+    parser.add_argument('output_dir', nargs='?', default=default_parquet_output_dir)
+    parser.add_argument('--explode-spikes', action='store_true',
+                        help='one row per spike, to the unit_spike_times_exploded dataset')
+    args = parser.parse_args()
+
+    activate()
+    for skey in acquisition.Session.fetch('KEY'):
+        export_to_parquet(skey, parquet_output_dir=args.output_dir, explode_spikes=args.explode_spikes)
@@ -1,4 +1,5 @@
 import os
+import sys
 import numpy as np
 from decimal import Decimal
 import scipy.io as sio
@@ -8,9 +9,12 @@ import glob
 import datajoint as dj
 from collections import Iterable
 import pathlib
+import argparse
+import queue
+import threading
 
-from pipeline import (reference, subject, acquisition,
-                      extracellular, behavior, utilities)
+from pipeline import (activate, reference, subject, acquisition,
+                      extracellular, behavior, utilities, npy_store)
 
 # ================== Setup ==================
 hemi_dict = {'L': 'left', 'R': 'right', 'B': 'bilateral'}
@@ -20,166 +24,258 @@ trial_type_and_response_dict = {0: ('lick right', 'correct'),
                                 3: ('lick left', 'incorrect'),
                                 4: ('lick right', 'no response'),
                                 5: ('lick left', 'no response')}
+
+# Ingestion runs as 3 stages, connected by bounded queues, so that the next session is being decoded and transformed
+# while the current one is being inserted:
+#   read_sessions (thread) -> transform_session (thread) -> insert_session (main thread, the only one using the database)
+default_read_queue_size = 2  # decoded sessions waiting to be transformed
+default_insert_queue_size = 2  # transformed sessions waiting to be inserted
+
+
+# ================== Read ==================
+def read_sessions(fnames):
+    """ Decode the MATLAB files, yielding the structs of one session at a time """
+    for fname in fnames:
+        mat = sio.loadmat(fname, struct_as_record = False, squeeze_me = True)
+        for sess_idx, (sess_meta, sess_obj, _, sess_psth) in enumerate(
+                zip(mat['meta'], mat['obj'], mat['tt'], mat['psth'])):
+            yield dict(fname=fname, sess_idx=sess_idx, sess_meta=sess_meta, sess_obj=sess_obj,
+                       sess_psth=sess_psth, psth_time=mat['time'])
+
+
+# ================== Transform ==================
+def transform_session(fname, sess_idx, sess_meta, sess_obj, sess_psth, psth_time, cell_type_tag):
+    """ Build the rows to be inserted for one session - no database access here """
+    subject_id, session_time = sess_meta.filename.replace('.mat', '').split('_')[-2:]
+
+    # --- Subject - No info on: animal sex, dob, source, strains
+    subject_info = dict(subject_id=subject_id.lower(),
+                        species='Mus musculus',  # not available, hard-coded here
+                        animal_source='N/A')  # animal source not available from data, nor 'sex'
+
+    # --- Session - no session types
+    session_info = dict(subject_id=subject_info['subject_id'],
+                        session_id=sess_idx,
+                        session_time=utilities.parse_date(session_time))
+
+    experimenters = ['Mike Economo']  # hard-coded here
+
+    # --- Probe ---
+    probe = {'probe_name': sess_obj.sessionMeta.probeName,
+             'channel_counts': sum(g.size for g in sess_obj.sessionMeta.siteGroups)}
+    shanks = [dict(probe, shank_id=int(shank.replace('shank', '')))
+              for shank in sess_obj.sessionMeta.siteLabels]
+    channels = [dict(probe, channel_id=chn, shank_id=int(shank.replace('shank', '')))
+                for chns, shank in zip(sess_obj.sessionMeta.siteGroups, sess_obj.sessionMeta.siteLabels)
+                for chn in chns]
+
+    # --- ProbeInsertion ---
+    # brain location
+    brain_region, hemisphere = sess_obj.sessionMeta.location.split('_')
+    brain_location = {'brain_region': brain_region,
+                      'brain_subregion': 'N/A',
+                      'cortical_layer': '5',  # layer 5, hard-coded info from the paper
+                      'hemisphere': hemi_dict[hemisphere]}
+
+    probe_insert = {**session_info, **probe, **brain_location,
+                    'insertion_depth': Decimal(sess_obj.sessionMeta.depth)}
+
+    # --- TrialSet ---
+    trial_time_convert = utilities.time_unit_conversion_factor[sess_obj.timeUnitNames[
+        sess_obj.trialTimeUnit - 1]]  # (-1) to take into account Matlab's 1-based indexing
+
+    trial_set = dict(session_info, trial_counts=len(sess_obj.trialIDs))
+    trials, trial_events = [], []
+
+    trial_properties = sess_obj.trialPropertiesHash.value
+    for trial_idx, (trial_id, trial_start, trial_type, good_trial, pole_in, pole_out,
+                    cue_start) in enumerate(
+        zip(sess_obj.trialIDs, sess_obj.trialStartTimes * trial_time_convert, sess_obj.trialTypeMat.T,
+            trial_properties[3], trial_properties[0] * trial_time_convert,
+            trial_properties[1] * trial_time_convert, trial_properties[2] * trial_time_convert)):
+
+        trial_key = dict(session_info, trial_id=trial_idx + 1)  # trial-number starts from 1
+        trial = dict(trial_key, start_time=trial_start, trial_stim_present=trial_type[-1], trial_is_good=good_trial)
+
+        if trial_type[6]:
+            trial['trial_type'] = 'lick left' if trial_type[1] or trial_type[3] else 'lick right'
+            trial['trial_response'] = 'early lick'
+        else:
+            trial['trial_type'], trial['trial_response'] = trial_type_and_response_dict[
+                np.where(trial_type[:6])[0][0]]
+        trials.append(trial)
+
+        # ======== Now add trial event timing to the EventTime part table ====
+        events_time = dict(pole_in=pole_in, pole_out=pole_out, cue_start=cue_start)
+        trial_events.extend(dict(trial_key, trial_event=k, event_time=e) for k, e in events_time.items())
+
+    # --- Extracellular ---
+    if sess_meta.unitNumber < 2:
+        sess_meta.unitNum = sess_meta.unitNum,
+        sess_obj.eventSeriesHash.value = sess_obj.eventSeriesHash.value,
+        sess_meta.depth = sess_meta.depth,
+        sess_meta.channel = sess_meta.channel,
+
+    unit_cell_type = cell_type_tag[os.path.split(fname)[-1].replace('.mat', '')]
+    trial_cue = sess_obj.trialPropertiesHash.value[2] * trial_time_convert  # cue onset relative to the start of the behavior system
+    trial_start = sess_obj.trialStartTimes * trial_time_convert
+
+    units = []
+    for unit_id, unit_val, unit_depth, unit_chn in zip(
+            sess_meta.unitNum, sess_obj.eventSeriesHash.value,
+            sess_meta.depth, sess_meta.channel):
+        unit_time_convert = utilities.time_unit_conversion_factor[sess_obj.timeUnitNames[unit_val.timeUnit - 1]]  # (-1) to take into account Matlab's 1-based indexing
+        cell_type = 'unidentified' if unit_id <= 1000 else unit_cell_type if unit_id <= 2000 else 'L6 corticothalamic'
+        # -- reconstruct session-long spike times from trial-based cue-aligned spike times
+        # (obj.eventSeriesHash.value are spike times relative to go-cue)
+        if not isinstance(unit_val.eventTrials, Iterable):
+            print(unit_val.eventTrials)
+            unit_val.eventTrials = np.array([unit_val.eventTrials])
+        trial_based_timeshift = np.array([trial_start[tr] + trial_cue[tr] for tr in unit_val.eventTrials - 1])
+        unit_sess_spike_times = unit_val.eventTimes * unit_time_convert + trial_based_timeshift
+        units.append(dict(probe_insert, unit_id=unit_id, channel_id=unit_chn, unit_cell_type=cell_type,
+                          unit_quality=str(unit_val.quality), unit_depth=unit_depth,
+                          spike_times=unit_sess_spike_times))
+
+    # --- Behavior ---
+    # reconstruct session-long lick times from trial-aligned lick times
+    left_licks = np.hstack([licks * trial_time_convert + trial_start[l_idx]
+                            for l_idx, licks in enumerate(sess_obj.trialPropertiesHash.value[5])])
+    right_licks = np.hstack([licks * trial_time_convert + trial_start[l_idx]
+                             for l_idx, licks in enumerate(sess_obj.trialPropertiesHash.value[6])])
+    lick_times = dict(session_info, lick_left_times=left_licks, lick_right_times=right_licks)
+
+    # --- PSTH - the PSTH are actually already computed and now needed to be imported into DJ pipeline
+    # Pre-computed PSTH are time-locked to cue-start (-3.3975s to 2.9975s)
+    if sess_psth.ndim < 3:
+        sess_psth = sess_psth.reshape((sess_psth.shape[0], 1, sess_psth.shape[1]))
+    psths = [dict(probe_insert, unit_id=sess_meta.unitNum[unit_idx], trial_id=trial_idx + 1, trial_seg_setting=0,
+                  psth=psth, psth_time=psth_time)
+             for unit_idx, unit_psths in enumerate(sess_psth.transpose((1, 2, 0)))
+             for trial_idx, psth in enumerate(unit_psths)]
+
+    return dict(subject_info=subject_info, session_info=session_info, experimenters=experimenters,
+                probe=dict(probe, probe_type=sess_obj.sessionMeta.probeType), shanks=shanks, channels=channels,
+                brain_location=brain_location, probe_insert=probe_insert,
+                trial_set=trial_set, trials=trials, trial_events=trial_events,
+                units=units, lick_times=lick_times, psths=psths)
+
+
+# ================== Insert ==================
+def insert_session(subject_info, session_info, experimenters, probe, shanks, channels, brain_location, probe_insert,
+                   trial_set, trials, trial_events, units, lick_times, psths):
+    subject.Subject.insert1(subject_info, skip_duplicates=True)
+
+    with acquisition.Session.connection.transaction:
+        if session_info not in acquisition.Session.proj():
+            acquisition.Session.insert1(session_info, ignore_extra_fields=True)
+            acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
+                                                     for k in experimenters), ignore_extra_fields=True)
+        print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
+
+    # --- Probe ---
+    probe_key = {k: probe[k] for k in reference.Probe.primary_key}
+    with reference.Probe.connection.transaction:
+        if probe_key not in reference.Probe.proj():
+            reference.Probe.insert1(probe)
+            reference.Probe.Shank.insert(shanks)
+            reference.Probe.Channel.insert(channels)
+
+    # --- ProbeInsertion ---
+    reference.BrainLocation.insert1(brain_location, skip_duplicates = True)
+    extracellular.ProbeInsertion.insert1(probe_insert, skip_duplicates=True)
+
+    # --- TrialSet ---
+    with acquisition.TrialSet.connection.transaction:
+        if trial_set not in acquisition.TrialSet.proj():
+            acquisition.TrialSet.insert1(trial_set)
+            acquisition.TrialSet.Trial.insert(trials, ignore_extra_fields=True, skip_duplicates=True)
+            acquisition.TrialSet.EventTime.insert(trial_events, ignore_extra_fields=True, skip_duplicates=True)
+
+    # --- Extracellular ---
+    if not (extracellular.UnitSpikeTimes & probe_insert):
+        extracellular.UnitSpikeTimes.insert(units, skip_duplicates=True)
+
+    # --- Behavior ---
+    if lick_times is not None and not (behavior.LickTimes & session_info):
+        behavior.LickTimes.insert1(lick_times, skip_duplicates=True)
+
+    # --- Cue-start aligned spike times
+    extracellular.TrialSegmentedUnitSpikeTimes.populate(probe_insert)
+    # --- Coarse time index of the spike times, for ad-hoc time-window extraction
+    # (units with spike times not in ascending order get no index - their windows are cut from the sorted spike times)
+    for index_error in extracellular.UnitSpikeTimeIndex.populate(probe_insert, suppress_errors=True) or []:
+        print(f'Spike time index error - {index_error}', file=sys.stderr)
+
+    # --- PSTH
+    extracellular.PSTH.insert(psths, skip_duplicates=True, allow_direct_insert=True)
+
+    # --- npy store - keep a memory-mappable copy of the large arrays of this session, if configured
+    # (overwrite, in case files were left over from deleted rows of this session)
+    if npy_store.is_configured():
+        for table in (extracellular.UnitSpikeTimes, extracellular.TrialSegmentedUnitSpikeTimes,
+                      extracellular.PSTH, behavior.LickTimes):
+            npy_store.migrate(table & session_info, overwrite=True)
+
+
+# ================== Pipeline ==================
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+_end_of_stage = object()
+
+
+def run_in_thread(iterable, queue_size):
+    """
+    Consume "iterable" on a background thread, handing its items over through a queue of at most "queue_size"
+    items (the thread blocks when the queue is full) - errors are re-raised in the consuming thread
+    """
+    item_queue = queue.Queue(maxsize=queue_size)
+
+    def produce():
+        try:
+            for item in iterable:
+                item_queue.put(item)
+        except Exception as e:
+            item_queue.put(_StageError(e))
+        item_queue.put(_end_of_stage)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = item_queue.get()
+        if item is _end_of_stage:
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+
+def ingest(fnames, cell_type_tag, read_queue_size=default_read_queue_size,
+           insert_queue_size=default_insert_queue_size):
+    decoded_sessions = run_in_thread(read_sessions(fnames), read_queue_size)
+    transformed_sessions = run_in_thread((transform_session(**sess, cell_type_tag=cell_type_tag)
+                                          for sess in decoded_sessions), insert_queue_size)
+    for session_rows in tqdm(transformed_sessions):
+        insert_session(**session_rows)
+
+
 # ================== Dataset ==================
-path = pathlib.Path(dj.config['custom'].get('data_directory')).as_posix()
-
-cell_type_tag = pd.read_excel(os.path.join(path, 'Animal Key.xlsx'),
-                              index_col=0, usecols='A, B').to_dict().pop('Cell type tagged')
-
-fnames = glob.glob(os.path.join(path, '*.mat'))
-for fname in fnames:
-    mat = sio.loadmat(fname, struct_as_record = False, squeeze_me = True)
-    for sess_idx, (sess_meta, sess_obj, sess_tt, sess_psth) in tqdm(
-            enumerate(zip(mat['meta'], mat['obj'], mat['tt'], mat['psth']))):
-
-        subject_id, session_time = sess_meta.filename.replace('.mat', '').split('_')[-2:]
-
-        # --- Subject - No info on: animal sex, dob, source, strains
-        subject_info = dict(subject_id=subject_id.lower(),
-                            species='Mus musculus',  # not available, hard-coded here
-                            animal_source='N/A')  # animal source not available from data, nor 'sex'
-        subject.Subject.insert1(subject_info, skip_duplicates=True)
-
-        # --- Session - no session types
-        session_info = dict(subject_id=subject_info['subject_id'],
-                            session_id=sess_idx,
-                            session_time=utilities.parse_date(session_time))
-
-        experimenters = ['Mike Economo']  # hard-coded here
-
-        with acquisition.Session.connection.transaction:
-            if session_info not in acquisition.Session.proj():
-                acquisition.Session.insert1(session_info, ignore_extra_fields=True)
-                acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
-                                                         for k in experimenters), ignore_extra_fields=True)
-            print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
-
-        # --- Probe ---
-        probe = {'probe_name': sess_obj.sessionMeta.probeName,
-                 'channel_counts': sum(g.size for g in sess_obj.sessionMeta.siteGroups)}
-        with reference.Probe.connection.transaction:
-            if probe not in reference.Probe.proj():
-                reference.Probe.insert1(dict(probe, probe_type=sess_obj.sessionMeta.probeType))
-                reference.Probe.Shank.insert(dict(probe, shank_id=int(shank.replace('shank', '')))
-                                             for shank in sess_obj.sessionMeta.siteLabels)
-                for chns, shank in zip(sess_obj.sessionMeta.siteGroups, sess_obj.sessionMeta.siteLabels):
-                    reference.Probe.Channel.insert(dict(probe, channel_id=chn,
-                                                        shank_id=int(shank.replace('shank', '')))
-                                               for chn in chns)
-
-        # --- ProbeInsertion ---
-        # brain location
-        brain_region, hemisphere = sess_obj.sessionMeta.location.split('_')
-        brain_location = {'brain_region': brain_region,
-                          'brain_subregion': 'N/A',
-                          'cortical_layer': '5',  # layer 5, hard-coded info from the paper
-                          'hemisphere': hemi_dict[hemisphere]}
-        reference.BrainLocation.insert1(brain_location, skip_duplicates = True)
-
-        probe_insert = {**session_info, **probe, **brain_location,
-                        'insertion_depth': Decimal(sess_obj.sessionMeta.depth)}
-        extracellular.ProbeInsertion.insert1(probe_insert, skip_duplicates=True)
-
-        # --- TrialSet ---
-        trial_time_convert = utilities.time_unit_conversion_factor[sess_obj.timeUnitNames[
-            sess_obj.trialTimeUnit - 1]]  # (-1) to take into account Matlab's 1-based indexing
-
-        trial_key = dict(session_info, trial_counts=len(sess_obj.trialIDs))
-        with acquisition.TrialSet.connection.transaction:
-            if trial_key not in acquisition.TrialSet.proj():
-                acquisition.TrialSet.insert1(trial_key)
-
-                trial_properties = sess_obj.trialPropertiesHash.value
-                for trial_idx, (trial_id, trial_start, trial_type, good_trial, pole_in, pole_out,
-                                cue_start) in enumerate(
-                    zip(sess_obj.trialIDs, sess_obj.trialStartTimes * trial_time_convert, sess_obj.trialTypeMat.T,
-                        trial_properties[3], trial_properties[0] * trial_time_convert,
-                        trial_properties[1] * trial_time_convert, trial_properties[2] * trial_time_convert)):
-
-                    trial_key['trial_id'] = trial_idx + 1  # trial-number starts from 1
-                    trial_key['start_time'] = trial_start
-                    trial_key['trial_stim_present'] = trial_type[-1]
-                    trial_key['trial_is_good'] = good_trial
-
-                    if trial_type[6]:
-                        trial_key['trial_type'] = 'lick left' if trial_type[1] or trial_type[3] else 'lick right'
-                        trial_key['trial_response'] = 'early lick'
-                    else:
-                        trial_key['trial_type'], trial_key['trial_response'] = trial_type_and_response_dict[
-                            np.where(trial_type[:6])[0][0]]
-
-                    acquisition.TrialSet.Trial.insert1(trial_key, ignore_extra_fields=True, skip_duplicates=True)
-
-                    # ======== Now add trial event timing to the EventTime part table ====
-                    events_time = dict(pole_in=pole_in, pole_out=pole_out, cue_start=cue_start)
-                    # -- events timing
-                    acquisition.TrialSet.EventTime.insert((dict(trial_key, trial_event=k, event_time=e)
-                                                           for k, e in events_time.items()),
-                                                          ignore_extra_fields=True, skip_duplicates=True)
-
-        # --- Extracellular ---
-        if sess_meta.unitNumber < 2:
-            sess_meta.unitNum = sess_meta.unitNum,
-            sess_obj.eventSeriesHash.value = sess_obj.eventSeriesHash.value,
-            sess_meta.depth = sess_meta.depth,
-            sess_meta.channel = sess_meta.channel,
-
-        unit_cell_type = cell_type_tag[os.path.split(fname)[-1].replace('.mat', '')]
-        trial_cue = sess_obj.trialPropertiesHash.value[2] * trial_time_convert  # cue onset relative to the start of the behavior system
-        trial_start = sess_obj.trialStartTimes * trial_time_convert
-
-        # cuetm: time of cue-onset with respect to the start of the ephys-recording system
-        cuetm = np.full_like(sess_obj.sessionMeta.bitcode, -1).astype(float)
-        cuetm[:len(sess_obj.sessionMeta.cuetm)] = sess_obj.sessionMeta.cuetm
-        cuetm = cuetm[sess_obj.sessionMeta.bitcode > 0]
-
-        starttm = sess_obj.sessionMeta.trialStartTm[sess_obj.sessionMeta.bitcode > 0]
-        t_offset = cuetm - trial_cue + starttm + trial_start
-
-        def extract_unit_data():
-            for unit_id, unit_val, unit_depth, unit_chn in zip(
-                    sess_meta.unitNum, sess_obj.eventSeriesHash.value,
-                    sess_meta.depth, sess_meta.channel):
-                unit_time_convert = utilities.time_unit_conversion_factor[sess_obj.timeUnitNames[unit_val.timeUnit - 1]]  # (-1) to take into account Matlab's 1-based indexing
-                cell_type = 'unidentified' if unit_id <= 1000 else unit_cell_type if unit_id <= 2000 else 'L6 corticothalamic'
-                # -- reconstruct session-long spike times from trial-based cue-aligned spike times
-                # (obj.eventSeriesHash.value are spike times relative to go-cue)
-                if not isinstance(unit_val.eventTrials, Iterable):
-                    print(unit_val.eventTrials)
-                    unit_val.eventTrials = np.array([unit_val.eventTrials])
-                trial_based_timeshift = np.array([trial_start[tr] + trial_cue[tr] for tr in unit_val.eventTrials - 1])
-                unit_sess_spike_times = unit_val.eventTimes * unit_time_convert + trial_based_timeshift
-                yield (unit_id, unit_depth, cell_type,
-                       unit_chn, str(unit_val.quality), unit_sess_spike_times)
-
-        if not (extracellular.UnitSpikeTimes & probe_insert):
-            extracellular.UnitSpikeTimes.insert(
-                (dict(probe_insert, unit_id=unit_id, channel_id=chn, unit_cell_type=unit_cell_type,
-                      unit_quality=quality, unit_depth=unit_depth, spike_times=spike_times)
-                 for unit_id, unit_depth, unit_cell_type, chn, quality, spike_times in extract_unit_data()), skip_duplicates=True)
-
-        # --- Behavior ---
-        # reconstruct session-long lick times from trial-aligned lick times
-        if not (behavior.LickTimes & session_info):
-            left_licks = np.hstack(licks * trial_time_convert + trial_start[l_idx]
-                                        for l_idx, licks in enumerate(sess_obj.trialPropertiesHash.value[5]))
-            right_licks = np.hstack(licks * trial_time_convert + trial_start[l_idx]
-                                        for l_idx, licks in enumerate(sess_obj.trialPropertiesHash.value[6]))
-
-            behavior.LickTimes.insert1(dict(session_info, lick_left_times=left_licks, lick_right_times=right_licks),
-                                       skip_duplicates=True)
-
-        # --- Cue-start aligned spike times
-        extracellular.TrialSegmentedUnitSpikeTimes.populate(probe_insert)
-
-        # --- PSTH - the PSTH are actually already computed and now needed to be imported into DJ pipeline
-        # Pre-computed PSTH are time-locked to cue-start (-3.3975s to 2.9975s)
-        if sess_psth.ndim < 3:
-            sess_psth = sess_psth.reshape((sess_psth.shape[0], 1, sess_psth.shape[1]))
-        for unit_idx, psths in enumerate(sess_psth.transpose((1, 2, 0))):
-            extracellular.PSTH.insert((dict(
-                probe_insert,
-                unit_id=sess_meta.unitNum[unit_idx],
-                trial_id=trial_idx+1, trial_seg_setting=0,
-                psth=psth, psth_time=mat['time']) for trial_idx, psth in enumerate(psths)),
-                skip_duplicates=True, allow_direct_insert=True)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the Economo 2018 dataset into the pipeline')
+    parser.add_argument('--read-queue-size', type=int, default=default_read_queue_size,
+                        help='max number of decoded sessions waiting to be transformed')
+    parser.add_argument('--insert-queue-size', type=int, default=default_insert_queue_size,
+                        help='max number of transformed sessions waiting to be inserted')
+    args = parser.parse_args()
+
+    activate()
+
+    path = pathlib.Path(dj.config['custom'].get('data_directory')).as_posix()
+
+    cell_type_tag = pd.read_excel(os.path.join(path, 'Animal Key.xlsx'),
+                                  index_col=0, usecols='A, B').to_dict().pop('Cell type tagged')
+
+    fnames = glob.glob(os.path.join(path, '*.mat'))
+    ingest(fnames, cell_type_tag, read_queue_size=args.read_queue_size, insert_queue_size=args.insert_queue_size)
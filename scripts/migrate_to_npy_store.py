@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+import sys
+
+import datajoint as dj
+
+from pipeline import (activate, extracellular, behavior, npy_store)
+
+# ============================== MIGRATE ALL ==========================================
+# Copy the array attributes of all existing rows into the npy store, and build the missing spike time indices
+# (UnitSpikeTimeIndex, only populated at ingestion) used by get_windowed_spike_times() on the memory-mapped spikes
+# The store location is taken from the command line argument, or dj.config['custom']['npy_store.location']
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        dj.config['custom']['npy_store.location'] = sys.argv[1]
+
+    activate()
+
+    for table in (extracellular.UnitSpikeTimes, extracellular.TrialSegmentedUnitSpikeTimes,
+                  extracellular.PSTH, behavior.LickTimes):
+        file_count = npy_store.migrate(table())
+        print(f'{table.__name__}: {file_count} file(s) written to the npy store')
+
+    # units with spike times not in ascending order get no index - their windows are cut from the sorted spike times
+    index_errors = extracellular.UnitSpikeTimeIndex.populate(suppress_errors=True) or []
+    for index_error in index_errors:
+        print(f'Spike time index error - {index_error}', file=sys.stderr)
+    print(f'UnitSpikeTimeIndex: {len(extracellular.UnitSpikeTimeIndex())} unit(s) indexed, '
+          f'{len(index_errors)} error(s)')
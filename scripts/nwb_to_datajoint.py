@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import sys
+import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import warnings
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from pipeline import (activate, utilities)
+from ingestion import insert_session
+
+warnings.filterwarnings('ignore', module='pynwb')
+
+# ============================== SET CONSTANTS ==========================================
+default_nwb_input_dir = os.path.join('data', 'NWB 2.0')
+default_workers = os.cpu_count() or 1
+
+
+def _to_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _split_ragged(data, index):
+    """ Split the flat "data" of a ragged NWB column by its "index" (end offset of each row) """
+    return np.split(np.asarray(data), np.asarray(index, dtype=int)[:-1])
+
+
+def read_nwb(nwb_file_path):
+    """
+    Read one NWB 2.0 file written by datajoint_to_nwb.export_to_nwb(), into the rows to be inserted into the pipeline
+    Datasets are read lazily from the file (h5py-backed), each column in one bulk read - no database access here
+    """
+    with NWBHDF5IO(nwb_file_path, mode='r') as io:
+        nwbfile = io.read()
+
+        # =============== Subject & Session ====================
+        subject_id, session_date, session_id = nwbfile.identifier.rsplit('_', 2)
+        subject_info = dict(subject_id=subject_id,
+                            species=nwbfile.subject.species,
+                            sex=nwbfile.subject.sex,
+                            subject_description=nwbfile.subject.description,
+                            animal_source='N/A')  # not exported
+        session_info = dict(subject_id=subject_id,
+                            session_id=int(session_id),
+                            session_time=utilities.parse_date(session_date))
+        experimenters = nwbfile.experimenter
+        experimenters = experimenters.split('; ') if isinstance(experimenters, str) else list(experimenters or [])
+
+        # =============== Extracellular ====================
+        if not nwbfile.electrode_groups or nwbfile.trials is None:
+            raise ValueError(f'{nwb_file_path}: no electrode group or trials - not exported with datajoint_to_nwb.py')
+        electrode_group = next(iter(nwbfile.electrode_groups.values()))
+        electrode_columns = {c.name: c for c in nwbfile.electrodes.columns}
+        if 'shank_id' not in electrode_columns or 'insertion depth (um): ' not in electrode_group.description:
+            raise ValueError(f'{nwb_file_path}: no "shank_id" electrode column or insertion depth'
+                             f' - re-export with datajoint_to_nwb.py')
+        probe_name, channel_counts = electrode_group.name.rsplit(': ', 1)
+        group_info = dict(info.split(': ', 1) for info in electrode_group.description.split('; '))
+        probe_key = dict(probe_name=probe_name, channel_counts=int(channel_counts))
+        probe = dict(probe_key, probe_type=group_info.get('probe type', ''))  # probe_desc is not exported
+
+        channel_ids = np.asarray(nwbfile.electrodes.id.data[:])
+        shank_ids = np.asarray(electrode_columns['shank_id'].data[:])
+        shanks = [dict(probe_key, shank_id=int(shank_id)) for shank_id in np.unique(shank_ids)]
+        channels = [dict(probe_key, channel_id=int(chn), shank_id=int(shank_id))
+                    for chn, shank_id in zip(channel_ids, shank_ids)]
+
+        brain_location = dict(loc.split(': ', 1) for loc in electrode_group.location.split('; '))
+        brain_location.pop('brain_location_full_name', None)
+        insertion_depth = Decimal(group_info['insertion depth (um)'])
+        probe_insert = {**session_info, **probe_key, **brain_location, 'insertion_depth': insertion_depth}
+
+        units = nwbfile.units  # None if the probe insertion has no unit
+        unit_rows = []
+        if units is not None:
+            unit_columns = {c.name: c for c in units.columns}
+            unit_channels = [channel_ids[np.asarray(e, dtype=int)] for e in
+                             _split_ragged(units.electrodes.data[:], units.electrodes_index.data[:])]
+            unit_rows = [dict(probe_insert, unit_id=int(unit_id), channel_id=int(chns[0]),
+                              unit_depth=depth, unit_quality=_to_str(quality), unit_cell_type=_to_str(cell_type),
+                              spike_times=spike_times)
+                         for unit_id, chns, depth, quality, cell_type, spike_times in zip(
+                             units.id.data[:], unit_channels, unit_columns['depth'].data[:],
+                             unit_columns['quality'].data[:], unit_columns['cell_type'].data[:],
+                             _split_ragged(units.spike_times.data[:], units.spike_times_index.data[:]))]
+
+        # =============== TrialSet ====================
+        trials, trial_events = [], []
+        trial_columns = {c.name: np.asarray(c.data[:]) for c in nwbfile.trials.columns}
+        event_names = [c.replace('_time', '') for c in trial_columns
+                       if c.endswith('_time') and c not in ('start_time', 'stop_time')]
+        for row_idx, trial_id in enumerate(nwbfile.trials.id.data[:]):
+            trial_key = dict(session_info, trial_id=int(trial_id))
+            start_time = trial_columns['start_time'][row_idx]
+            trials.append(dict(trial_key,
+                               start_time=None if np.isnan(start_time) else start_time,
+                               trial_type=_to_str(trial_columns['type'][row_idx]),
+                               trial_response=_to_str(trial_columns['response'][row_idx]),
+                               trial_stim_present=bool(trial_columns['stim_present'][row_idx]),
+                               trial_is_good=bool(trial_columns['is_good'][row_idx])))
+            # trial event times were exported with respect to the session start - back to the trial start
+            for event in event_names:
+                event_time = trial_columns[event + '_time'][row_idx] - start_time
+                trial_events.append(dict(trial_key, trial_event=event,
+                                         event_time=None if np.isnan(event_time) else event_time))
+        trial_set = dict(session_info, trial_counts=len(trials))
+
+        # =============== Behavior ====================
+        lick_times = None
+        if 'lick_times' in nwbfile.acquisition:
+            lick_series = nwbfile.acquisition['lick_times'].time_series
+            lick_times = dict(session_info, **{k: np.asarray(lick_series[k].timestamps[:])
+                                               for k in ('lick_left_times', 'lick_right_times')})
+
+    return dict(subject_info=subject_info, session_info=session_info, experimenters=experimenters,
+                probe=probe, shanks=shanks, channels=channels, brain_location=brain_location,
+                probe_insert=probe_insert, trial_set=trial_set, trials=trials, trial_events=trial_events,
+                units=unit_rows, lick_times=lick_times, psths=[])  # PSTH are not exported to NWB
+
+
+def import_from_nwb(nwb_file_paths, workers=default_workers):
+    """
+    Read the NWB files in parallel ("workers" processes) and insert them into the pipeline as they come in
+    At most 2 x "workers" files are read ahead of the inserts, bounding the memory used
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        nwb_file_paths = iter(nwb_file_paths)
+        pending = deque(executor.submit(read_nwb, f) for _, f in zip(range(2 * workers), nwb_file_paths))
+        while pending:
+            session_rows = pending.popleft().result()
+            next_file = next(nwb_file_paths, None)
+            if next_file is not None:
+                pending.append(executor.submit(read_nwb, next_file))
+            insert_session(**session_rows)
+
+
+# ============================== IMPORT ALL ==========================================
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        nwb_indir = sys.argv[1]
+    else:
+        nwb_indir = default_nwb_input_dir
+
+    activate()
+    import_from_nwb(sorted(glob.glob(os.path.join(nwb_indir, '*.nwb'))))
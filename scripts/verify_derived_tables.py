@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import datajoint as dj
+
+from pipeline import (activate, acquisition, analysis, extracellular)
+
+# ============================== SET CONSTANTS ==========================================
+default_rtol = 1e-6
+default_atol = 1e-6  # (s)
+default_psth_rtol = 0.1  # tolerance between the PSTH integral and the spike count - the imported PSTH are smoothed
+default_psth_atol = 2  # (spikes)
+
+
+def _lookup(keys, values, query_keys, default=np.nan):
+    """ values[keys == query_key] for each of the query_keys (default where absent) - keys being unique """
+    if not len(keys):
+        return np.full(len(query_keys), default), np.zeros(len(query_keys), dtype=bool)
+    order = np.argsort(keys)
+    keys, values = np.asarray(keys)[order], np.asarray(values, dtype=float)[order]
+    idx = np.minimum(np.searchsorted(keys, query_keys), len(keys) - 1)
+    is_found = keys[idx] == query_keys
+    return np.where(is_found, values[idx], default), is_found
+
+
+def _get_alignment_times(insertion_key, event):
+    """
+    Time of the alignment "event" of each trial, with respect to the trial start and to the session start
+    Trials without this event (or with a nan event time) are left out, as in the computed tables
+    """
+    trial_ids, start_times = (acquisition.TrialSet.Trial & insertion_key).fetch('trial_id', 'start_time')
+    event_trial_ids, event_times = (acquisition.TrialSet.EventTime & insertion_key
+                                    & {'trial_event': event}).fetch('trial_id', 'event_time')
+    event_times, _ = _lookup(event_trial_ids, event_times, trial_ids)
+    is_valid = ~np.isnan(event_times)
+    return (trial_ids[is_valid], event_times[is_valid],
+            event_times[is_valid] + np.asarray(start_times, dtype=float)[is_valid])
+
+
+def _ragged_take(values, starts, lengths):
+    """ Flat concatenation of the rows values[start:start + length] """
+    row_offsets = np.cumsum(lengths) - lengths
+    return values[np.arange(lengths.sum()) + np.repeat(starts - row_offsets, lengths)]
+
+
+def _flatten_rows(rows, sort_rows=False):
+    """ Blob rows (one array each) as (flat values, row lengths) - each row sorted if "sort_rows" """
+    lengths = np.fromiter(map(np.size, rows), dtype=int, count=len(rows))
+    values = np.concatenate([np.empty(0)] + list(rows), axis=None).astype(float)
+    if sort_rows:
+        values = values[np.lexsort((values, np.repeat(np.arange(len(rows)), lengths)))]
+    return values, lengths
+
+
+def _key_array(key_columns, key_dtype):
+    keys = np.empty(len(key_columns[0]), dtype=key_dtype)
+    for name, column in zip(keys.dtype.names, key_columns):
+        keys[name] = column
+    return keys
+
+
+def _compare(table_name, expected, stored, rtol, atol):
+    """
+    Compare the expected and stored rows, each given as (key columns, flat values, row lengths), in bulk: the rows are
+    matched by key, then their lengths and all their values are compared at once
+    :return: list of mismatches as (table, key, reason)
+    """
+    (exp_columns, exp_values, exp_lengths), (sto_columns, sto_values, sto_lengths) = expected, stored
+    exp_columns, sto_columns = ([np.asarray(c).astype(str) if np.asarray(c).dtype == object else np.asarray(c)
+                                 for c in columns] for columns in (exp_columns, sto_columns))
+    key_dtype = [(f'k{i}', np.promote_types(e.dtype, s.dtype) if len(e) and len(s) else (e if len(e) else s).dtype)
+                 for i, (e, s) in enumerate(zip(exp_columns, sto_columns))]
+    exp_keys, sto_keys = _key_array(exp_columns, key_dtype), _key_array(sto_columns, key_dtype)
+    _, exp_idx, sto_idx = np.intersect1d(exp_keys, sto_keys, assume_unique=True, return_indices=True)
+
+    mismatches = [(table_name, k, 'missing') for k in np.delete(exp_keys, exp_idx).tolist()]
+    mismatches += [(table_name, k, 'unexpected') for k in np.delete(sto_keys, sto_idx).tolist()]
+
+    # matched rows of different lengths are mismatches, the values of the others are compared in one pass
+    is_same_length = exp_lengths[exp_idx] == sto_lengths[sto_idx]
+    mismatches += [(table_name, k, 'value') for k in exp_keys[exp_idx[~is_same_length]].tolist()]
+    exp_idx, sto_idx = exp_idx[is_same_length], sto_idx[is_same_length]
+    lengths = exp_lengths[exp_idx]
+    exp_flat = _ragged_take(exp_values, (np.cumsum(exp_lengths) - exp_lengths)[exp_idx], lengths)
+    sto_flat = _ragged_take(sto_values, (np.cumsum(sto_lengths) - sto_lengths)[sto_idx], lengths)
+    is_bad = np.append(~np.isclose(exp_flat, sto_flat, rtol=rtol, atol=atol, equal_nan=True), False)
+    is_bad_row = np.zeros(len(lengths), dtype=bool)
+    if len(lengths):
+        is_bad_row = (np.add.reduceat(is_bad, np.cumsum(lengths) - lengths) > 0) & (lengths > 0)
+
+    mismatches += [(table_name, k, 'value') for k in exp_keys[exp_idx[is_bad_row]].tolist()]
+    return mismatches
+
+
+def verify_insertion(insertion_key, seg_setting_key, rtol=default_rtol, atol=default_atol,
+                     psth_rtol=default_psth_rtol, psth_atol=default_psth_atol):
+    """
+    Rebuild the expected derived values of one probe insertion and trial segmentation setting, in bulk, and compare
+    them against the stored rows of TrialSegmentedUnitSpikeTimes, RealignedEvent.RealignedEventTime and PSTH
+    Only the populated entries are verified: the (probe insertion, setting) of TrialSegmentedUnitSpikeTimes with
+    stored rows, and the trials with a RealignedEvent row - the PSTH rows are checked as stored
+    :return: list of mismatches as (table, key, reason) - key being (unit_id, trial_id) or (trial_id, trial_event)
+    """
+    event, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & seg_setting_key).fetch1(
+        'event', 'pre_stim_duration', 'post_stim_duration')
+    pre_stim_dur, post_stim_dur = float(pre_stim_dur), float(post_stim_dur)
+    trial_ids, trial_event_times, alignment_times = _get_alignment_times(insertion_key, event)
+
+    unit_ids, spike_times = (extracellular.UnitSpikeTimes & insertion_key).fetch('unit_id', 'spike_times')
+    spike_times = [np.sort(np.asarray(spk, dtype=float).ravel()) for spk in spike_times]
+
+    mismatches = []
+
+    # --- TrialSegmentedUnitSpikeTimes: slices of UnitSpikeTimes around the alignment event of each trial
+    # populated per (probe insertion, segmentation setting) in one make() - nothing stored: not populated, skipped
+    seg_unit_ids, seg_trial_ids, seg_spike_times = (
+        extracellular.TrialSegmentedUnitSpikeTimes & insertion_key & seg_setting_key).fetch(
+        'unit_id', 'trial_id', 'segmented_spike_times')
+    if len(seg_spike_times):
+        exp_values, exp_lengths = [np.empty(0)], [np.empty(0, dtype=int)]
+        for spk in spike_times:  # one pass per unit, over all trials
+            i_starts = np.searchsorted(spk, alignment_times - pre_stim_dur, side='left')
+            lengths = np.searchsorted(spk, alignment_times + post_stim_dur, side='right') - i_starts
+            exp_values.append(_ragged_take(spk, i_starts, lengths) - np.repeat(alignment_times, lengths))
+            exp_lengths.append(lengths)
+        expected = ((np.repeat(unit_ids, len(trial_ids)), np.tile(trial_ids, len(unit_ids))),
+                    np.concatenate(exp_values), np.concatenate(exp_lengths))
+        stored = ((seg_unit_ids, seg_trial_ids), *_flatten_rows(seg_spike_times, sort_rows=True))
+        mismatches += _compare('TrialSegmentedUnitSpikeTimes', expected, stored, rtol, atol)
+
+    # --- RealignedEventTime: EventTime minus the alignment event time of the trial
+    # populated per trial - only the trials of which the RealignedEvent master is populated are expected
+    realigned_trial_ids = (analysis.RealignedEvent & insertion_key & seg_setting_key).fetch('trial_id')
+    is_realigned = np.isin(trial_ids, realigned_trial_ids)
+    ev_trial_ids, ev_names, ev_times = (acquisition.TrialSet.EventTime & insertion_key).fetch(
+        'trial_id', 'trial_event', 'event_time')
+    ev_alignment, is_expected = _lookup(trial_ids[is_realigned], trial_event_times[is_realigned], ev_trial_ids)
+    expected = ((ev_trial_ids[is_expected], ev_names[is_expected]),
+                (np.asarray(ev_times, dtype=float) - ev_alignment)[is_expected], np.ones(is_expected.sum(), dtype=int))
+    rel_trial_ids, rel_names, rel_times = (analysis.RealignedEvent.RealignedEventTime
+                                           & insertion_key & seg_setting_key).fetch(
+        'trial_id', 'trial_event', 'realigned_event_time')
+    stored = ((rel_trial_ids, rel_names), np.asarray(rel_times, dtype=float), np.ones(len(rel_times), dtype=int))
+    mismatches += _compare('RealignedEvent.RealignedEventTime', expected, stored, rtol, atol)
+
+    # --- PSTH: the integral of each PSTH (spike rate sampled at psth_time) against the spike count over its time span
+    psth_unit_ids, psth_trial_ids, psths, psth_times = (extracellular.PSTH & insertion_key & seg_setting_key).fetch(
+        'unit_id', 'trial_id', 'psth', 'psth_time')
+    if len(psths):
+        unit_spikes = dict(zip(unit_ids, spike_times))
+        psths = np.concatenate(list(psths), axis=None).astype(float).reshape(len(psths), -1)
+        psth_time = np.asarray(psth_times[0], dtype=float).ravel()
+        bin_width = np.median(np.diff(psth_time))
+        t_align, is_aligned = _lookup(trial_ids, alignment_times, psth_trial_ids)
+
+        spike_counts = np.full(len(psths), np.nan)
+        for unit_id in np.unique(psth_unit_ids):
+            rows = np.where((psth_unit_ids == unit_id) & is_aligned)[0]
+            spk = unit_spikes.get(unit_id, np.empty(0))
+            spike_counts[rows] = (np.searchsorted(spk, t_align[rows] + psth_time[-1] + bin_width / 2, side='right')
+                                  - np.searchsorted(spk, t_align[rows] + psth_time[0] - bin_width / 2, side='left'))
+        psth_counts = np.nansum(psths, axis=1) * bin_width
+        is_mismatch = ~np.isclose(psth_counts, spike_counts, rtol=psth_rtol, atol=psth_atol)
+        mismatches += [('PSTH', (u, tr), 'spike count') for u, tr in
+                       zip(psth_unit_ids[is_mismatch], psth_trial_ids[is_mismatch])]
+
+    return mismatches
+
+
+def _verify(keys, **tolerances):
+    insertion_key, seg_setting_key = keys
+    return insertion_key, verify_insertion(insertion_key, seg_setting_key, **tolerances)
+
+
+def _init_worker():
+    activate()  # no-op when the schemas were activated before the worker process was forked
+    dj.conn().connect()  # own database connection, never share the parent process' one
+
+
+def verify_all(workers=None, **tolerances):
+    """ Verify all probe insertions, in parallel across "workers" processes - return {insertion_key: mismatches} """
+    insertion_keys = extracellular.ProbeInsertion.fetch('KEY')
+    seg_setting_keys = analysis.TrialSegmentationSetting.fetch('KEY')
+    keys = [(ins_key, seg_key) for ins_key in insertion_keys for seg_key in seg_setting_keys]
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(_verify, k, **tolerances) for k in keys]
+        for future in futures:
+            insertion_key, mismatches = future.result()
+            results.setdefault(tuple(insertion_key.items()), []).extend(mismatches)
+    return results
+
+
+# ============================== VERIFY ALL ==========================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify the derived spike, event and PSTH tables against their sources')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--rtol', type=float, default=default_rtol)
+    parser.add_argument('--atol', type=float, default=default_atol)
+    parser.add_argument('--psth-rtol', type=float, default=default_psth_rtol)
+    parser.add_argument('--psth-atol', type=float, default=default_psth_atol)
+    args = parser.parse_args()
+
+    activate()
+    results = verify_all(workers=args.workers, rtol=args.rtol, atol=args.atol,
+                         psth_rtol=args.psth_rtol, psth_atol=args.psth_atol)
+
+    mismatch_count = 0
+    for insertion_key, mismatches in results.items():
+        for table_name, key, reason in mismatches:
+            print(f'{table_name} - {dict(insertion_key)} - {key}: {reason}')
+        mismatch_count += len(mismatches)
+    print(f'{len(results)} probe insertion(s) verified - {mismatch_count} mismatch(es)')
+    raise SystemExit(1 if mismatch_count else 0)